@@ -0,0 +1,12 @@
+import os
+
+# Configure the app to use the testing database before py.test imports any
+# test module, since a module which imports posts at collection time would
+# otherwise build the app with DevelopmentConfig. Having this file at the
+# top of the repository also puts it on sys.path, so posts is importable.
+#
+# The testing database lives in memory, so each pytest-xdist worker gets
+# a database of its own, e.g. when running
+#
+#     py.test -n auto
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
@@ -1,11 +1,28 @@
-from sqlalchemy import create_engine, Column, Integer, String, Sequence
+from sqlalchemy import create_engine, event, Column, Integer, String, Sequence
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import StaticPool
 
 from posts import app
 
-engine = create_engine(app.config["DATABASE_URI"])
+database_uri = app.config["DATABASE_URI"]
+if database_uri in ("sqlite://", "sqlite:///:memory:"):
+    # An in-memory database only exists on its own connection, so share a
+    # single connection between every session and thread
+    engine = create_engine(database_uri,
+        connect_args={"check_same_thread": False}, poolclass=StaticPool)
+
+    # pysqlite issues its own BEGIN statements, which breaks the SAVEPOINTs
+    # the tests run inside. Turn that off and let SQLAlchemy emit BEGIN.
+    @event.listens_for(engine, "connect")
+    def sqlite_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def sqlite_begin(connection):
+        connection.execute("BEGIN")
+else:
+    engine = create_engine(database_uri)
 Base = declarative_base()
 Session = sessionmaker(bind=engine)
 session = Session()
-
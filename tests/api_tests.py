@@ -1,60 +1,170 @@
 import unittest
 import os
 import json
-from urlparse import urlparse
 
-# Configure our app to use the testing databse
-os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+from sqlalchemy import event
+from werkzeug.test import EnvironBuilder, run_wsgi_app
 
-from posts import app
-from posts import models
-from posts.database import Base, engine, session
+# Configure our app to use the testing databse. This has to happen before
+# anything imports posts, so it stays at module level.
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
 
-class TestAPI(unittest.TestCase):
-    """ Tests for the posts API """
+# The only databases the tests are allowed to create tables in and wipe
+_MEMORY_DATABASE_URIS = ("sqlite://", "sqlite:///:memory:")
+
+# Headers for requests which accept a JSON response
+_JSON_HEADERS = [("Accept", "application/json")]
+
+# Body of a valid post, serialized once for the tests which send it
+_POST_BODY = json.dumps({"title": "Example Post", "body": "Just a test"})
+
+def tearDownModule():
+    """ Module teardown """
+    # Nothing was created if no test class got as far as importing the app
+    if not hasattr(DatabaseTestCase, "engine"):
+        return
+
+    # Remove the tables from the database
+    DatabaseTestCase._require_memory_database()
+    DatabaseTestCase.Base.metadata.drop_all(DatabaseTestCase.engine)
+
+def restart_savepoint(session, transaction):
+    """ Begin a new SAVEPOINT whenever the app commits the current one """
+    if transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
+
+class DatabaseTestCase(unittest.TestCase):
+    """ Base class running each test inside a rolled back transaction """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Class setup """
+        # The app is only imported here so that collecting the tests
+        # doesn't build it
+        from posts import app
+        from posts import models
+        from posts.database import Base, engine, session
+
+        # These are the same for every class, so keep them on the base
+        # class where tearDownModule can find them too
+        DatabaseTestCase.app = app
+        DatabaseTestCase.models = models
+        DatabaseTestCase.Base = Base
+        DatabaseTestCase.engine = engine
+        DatabaseTestCase.session = session
+
+        # The test client keeps no state between requests as long as no
+        # cookies are set, so a single one is shared by the tests
+        cls.client = cls.app.test_client()
+
+        # Build the WSGI environ for a JSON GET request once, so _get only
+        # has to copy it and fill in the path and query string
+        builder = EnvironBuilder(path="/api/posts", method="GET",
+            headers=_JSON_HEADERS)
+        cls.json_get_environ = builder.get_environ()
+        builder.close()
+
+        cls._require_memory_database()
+
+        # Set up the tables in the database. They are kept between classes,
+        # so this only issues DDL for the first class to run.
+        cls.Base.metadata.create_all(cls.engine)
+
+    @classmethod
+    def tearDownClass(cls):
+        """ Class teardown """
+        cls._require_memory_database()
+
+        # Empty the tables for the next class. The posts table doesn't use
+        # AUTOINCREMENT, so SQLite starts its ids from 1 again once empty.
+        for table in reversed(cls.Base.metadata.sorted_tables):
+            cls.engine.execute(table.delete())
+
+    @classmethod
+    def _require_memory_database(cls):
+        """ Refuse to touch any database but the in-memory testing one """
+        database_uri = cls.app.config["DATABASE_URI"]
+        if database_uri not in _MEMORY_DATABASE_URIS:
+            raise RuntimeError("The tests must run against an in-memory "
+                "database, not {}. Was posts imported before CONFIG_PATH "
+                "was set?".format(database_uri))
 
     def setUp(self):
         """ Test setup """
-        self.client = app.test_client()
-
-        # Set up the tables in the database
-        Base.metadata.create_all(engine)
+        # Run each test inside a transaction which is rolled back in
+        # tearDown, so commits made by the app never reach the tables
+        self.connection = self.engine.connect()
+        self.trans = self.connection.begin()
+        self.session.bind = self.connection
+        self.session.begin_nested()
+        event.listen(self.session, "after_transaction_end", restart_savepoint)
 
     def tearDown(self):
         """ Test teardown """
-        # Remove the tables and their data from the database
-        Base.metadata.drop_all(engine)
-
-    def testGetEmptyPosts(self):
-        """ Getting posts from an empty database"""
-        response = self.client.get("/api/posts",
-            headers=[("Accept", "application/json")]
-            )
-
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.mimetype, "application/json")
-
-        data = json.loads(response.data)
-        self.assertEqual(data, [])
+        event.remove(self.session, "after_transaction_end", restart_savepoint)
+        self.session.close()
+        self.trans.rollback()
+        self.connection.close()
+        self.session.bind = self.engine
+
+    def _get(self, path, query_string=""):
+        """
+        Make a GET request which accepts JSON, reusing the base environ
+
+        The copy is shallow, so every request shares one wsgi.input stream.
+        Never use this for requests with a body.
+        """
+        environ = dict(self.json_get_environ)
+        environ["PATH_INFO"] = path
+        environ["QUERY_STRING"] = query_string
+        return self.app.response_class(*run_wsgi_app(self.app, environ))
+
+    def _json_ok(self, response, status=200):
+        """ Check the status and mimetype of a response and parse its body """
+        # Check these before parsing, so an HTML error page is reported as
+        # the wrong status rather than as a JSON decoding error
+        self.assertEqual((response.status_code, response.mimetype),
+            (status, "application/json"))
+        return json.loads(response.get_data())
+
+class TestAPIReadOnly(DatabaseTestCase):
+    """ Tests for the posts API which only read from the database """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Class setup """
+        super(TestAPIReadOnly, cls).setUpClass()
+
+        # Add the posts needed by every test in the class once, using a
+        # single executemany INSERT rather than one per post
+        posts = [
+            {"title": "Title A", "body": "Posting up over heeeere"},
+            {"title": "Other title", "body": "What a wonderful world"},
+            {"title": "Post with green eggs", "body": "Just a test"},
+            {"title": "Post with ham", "body": "Still a test"},
+            {"title": "Post with green eggs and ham", "body": "Still testing"},
+            {"title": "Green eggs and ham",
+                "body": "A post by Sam I Am about my favorite foods"},
+            {"title": "Green fish blue fish",
+                "body": "A post about Sam I Am's fish bowl"},
+            {"title": "Green is my favorite color",
+                "body": "A post by James about how much I love the color green"},
+            {"title": "The Cat in the Hat",
+                "body": "A post by Sam I Am about my greatest rival for power"}
+        ]
+        cls.session.execute(cls.models.Post.__table__.insert(), posts)
+        ids = cls.session.query(cls.models.Post.id).order_by(cls.models.Post.id)
+        cls.post_ids = [post_id for (post_id,) in ids]
+        cls.session.commit()
+        cls.session.close()
 
     def testGetPosts(self):
         """ Getting posts from a populated database """
-        postA = models.Post(title="Title A", body=
-            "Posting up over heeeere")
-        postB = models.Post(title="Other title", body=
-            "What a wonderful world")
-        session.add_all([postA, postB])
-        session.commit()
-
-        response = self.client.get("/api/posts",
-            headers=[("Accept", "application/json")] 
-            )
+        response = self._get("/api/posts")
 
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.mimetype, "application/json")
-
-        data = json.loads(response.data)
-        self.assertEqual(len(data), 2)
+        data = self._json_ok(response)
+        self.assertEqual(len(data), 9)
 
         postA = data[0]
         self.assertEqual(postA["title"], "Title A")
@@ -66,154 +176,88 @@ class TestAPI(unittest.TestCase):
 
     def testGetPost(self):
         """ Get a single post from a populated database """
-        postA = models.Post(title="Title A", body=
-            "Posting up over heeeere")
-        postB = models.Post(title="Other title", body=
-            "What a wonderful world")
-        session.add_all([postA, postB])
-        session.commit()
+        response = self._get("/api/posts/{}".format(self.post_ids[1]))
 
-        response = self.client.get("/api/posts/{}".format(postB.id),
-            headers=[("Accept", "application/json")]
-            )
+        self.assertEqual(self._json_ok(response), {
+            "id": self.post_ids[1],
+            "title": "Other title",
+            "body": "What a wonderful world"
+        })
 
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.mimetype, "application/json")
+    def _assert_filtered(self, query, expected):
+        """ Check that a filter query returns the expected posts in order """
+        response = self._get("/api/posts", query)
 
-        post = json.loads(response.data)
-        self.assertEqual(post["title"], "Other title")
-        self.assertEqual(post["body"], "What a wonderful world")
-
-    def testGetNonExistentPost(self):
-        """ Getting a single post which doesn't exist """
-        response = self.client.get("/api/posts/1",
-            headers=[("Accept", "application/json")]
-            )
-
-        self.assertEqual(response.status_code, 404)
-        self.assertEqual(response.mimetype, "application/json")
-
-        data = json.loads(response.data)
-        self.assertEqual(data["message"], "Could not find post with id 1")
-
-    def testUnsupportedAcceptHeader(self):
-        response = self.client.get("/api/posts", 
-            headers = [("Accept", "application/xml")]
-            )
-
-        self.assertEqual(response.status_code, 406)
-        self.assertEqual(response.mimetype, "application/json")
-
-        data = json.loads(response.data)
-        self.assertEqual(data["message"], 
-            "Request must accept application/json data")
+        posts = self._json_ok(response)
+        self.assertEqual([(post["title"], post["body"]) for post in posts],
+            expected)
 
     def testGetPostsWithTitle(self):
         """ Filtering posts by title """
-        postA = models.Post(title="Post with green eggs", body="Just a test")
-        postB = models.Post(title="Post with ham", body="Still a test")
-        postC = models.Post(title="Post with green eggs and ham", body="Another test")
-
-        session.add_all([postA, postB, postC])
-        session.commit()
-
-        response = self.client.get("/api/posts?title_like=ham",
-            headers=[("Accept", "application/json")]
-            )
-
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.mimetype, "application/json")
-
-        posts = json.loads(response.data)
-        self.assertEqual(len(posts), 2)
-
-        post = posts[0]
-        self.assertEqual(post["title"], "Post with ham")
-        self.assertEqual(post["body"], "Still a test")
-
-        post = posts[1]
-        self.assertEqual(post["title"], "Post with green eggs and ham")
-        self.assertEqual(post["body"], "Another test")
+        self._assert_filtered("title_like=ham", [
+            ("Post with ham", "Still a test"),
+            ("Post with green eggs and ham", "Still testing"),
+            ("Green eggs and ham", "A post by Sam I Am about my favorite foods")
+        ])
 
     def testGetPostsWithBody(self):
         """ Filtering posts by body """
-        postA = models.Post(title="Post with green eggs", body="Just a test")
-        postB = models.Post(title="Post with ham", body="Still a test")
-        postC = models.Post(title="Post with green eggs and ham", body="Still testing")
-        
-        session.add_all([postA, postB, postC])
-        session.commit()
-
-        response = self.client.get("/api/posts?body_like=still",
-            headers=[("Accept", "application/json")]
-            )
-
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.mimetype, "application/json")
-
-        posts = json.loads(response.data)
-        self.assertEqual(len(posts), 2)
-
-        post = posts[0]
-        self.assertEqual(post["title"], "Post with ham")
-        self.assertEqual(post["body"], "Still a test")
-
-        post = posts[1]
-        self.assertEqual(post["title"], "Post with green eggs and ham")
-        self.assertEqual(post["body"], "Still testing")
+        self._assert_filtered("body_like=still", [
+            ("Post with ham", "Still a test"),
+            ("Post with green eggs and ham", "Still testing")
+        ])
 
     def testGetPostsWithTitleAndBody(self):
         """ Filtering posts by title and body """
-        postA = models.Post(title="Green eggs and ham", body="A post by Sam I Am about my favorite foods")
-        postB = models.Post(title="Green fish blue fish", body="A post about Sam I Am's fish bowl")
-        postC = models.Post(title="Green is my favorite color", body="A post by James about how much I love the color green")
-        postD = models.Post(title="The Cat in the Hat", body="A post by Sam I Am about my greatest rival for power")
+        self._assert_filtered("title_like=green&body_like=Sam", [
+            ("Green eggs and ham", "A post by Sam I Am about my favorite foods"),
+            ("Green fish blue fish", "A post about Sam I Am's fish bowl")
+        ])
 
-        session.add_all([postA, postB, postC, postD])
-        session.commit()
+class TestAPIWithEmptyDatabase(DatabaseTestCase):
+    """ Tests for the posts API which start from an empty database """
 
-        response = self.client.get("/api/posts?title_like=green&body_like=Sam",
-            headers=[("Accept", "application/json")]
-            )
+    def testGetEmptyPosts(self):
+        """ Getting posts from an empty database"""
+        response = self._get("/api/posts")
 
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.mimetype, "application/json")
+        self.assertEqual(self._json_ok(response), [])
 
-        posts = json.loads(response.data)
-        self.assertEqual(len(posts), 2)
+    def testGetNonExistentPost(self):
+        """ Getting a single post which doesn't exist """
+        response = self._get("/api/posts/1")
 
-        post = posts[0]
-        self.assertEqual(post["title"], "Green eggs and ham")
-        self.assertEqual(post["body"], "A post by Sam I Am about my favorite foods")
+        self.assertEqual(self._json_ok(response, 404),
+            {"message": "Could not find post with id 1"})
+
+    def testUnsupportedAcceptHeader(self):
+        response = self.client.get("/api/posts", 
+            headers = [("Accept", "application/xml")]
+            )
 
-        post = posts[1]
-        self.assertEqual(post["title"], "Green fish blue fish")
-        self.assertEqual(post["body"], "A post about Sam I Am's fish bowl")
+        self.assertEqual(self._json_ok(response, 406),
+            {"message": "Request must accept application/json data"})
 
     def testPostPost(self):
         """ Posting a new post """
-        data = {
-        "title": "Example Post",
-        "body": "Just a test"
-        }
-
         response = self.client.post("/api/posts",
-            data=json.dumps(data),
+            data=_POST_BODY,
             content_type="application/json",
-           headers=[("Accept", "application/json")]
+            headers=_JSON_HEADERS
             )
 
-        self.assertEqual(response.status_code, 201)
-        self.assertEqual(response.mimetype, "application/json")
-        self.assertEqual(urlparse(response.headers.get("Location")).path,
-            "/api/posts/1")
+        data = self._json_ok(response, 201)
+        new_id = data["id"]
+        self.assertIsInstance(new_id, int)
+        self.assertEqual(response.location,
+            "http://localhost/api/posts/{}".format(new_id))
 
-        data = json.loads(response.data)
-        self.assertEqual(data["id"], 1)
         self.assertEqual(data["title"], "Example Post")
         self.assertEqual(data["body"], "Just a test")
 
-        posts = session.query(models.Post).all()
+        # Reload the posts rather than trusting the identity map
+        self.session.expire_all()
+        posts = self.session.query(self.models.Post).all()
         self.assertEqual(len(posts), 1)
 
         post = posts[0]
@@ -225,15 +269,11 @@ class TestAPI(unittest.TestCase):
         response = self.client.post("/api/posts",
             data=json.dumps(data),
             content_type="application/xml",
-            headers=[("Accept", "application/json")]
+            headers=_JSON_HEADERS
             )
 
-        self.assertEqual(response.status_code, 415)
-        self.assertEqual(response.mimetype,"application/json")
-
-        data = json.loads(response.data)
-        self.assertEqual(data["message"],
-            "Request must contain application/json data")
+        self.assertEqual(self._json_ok(response, 415),
+            {"message": "Request must contain application/json data"})
 
     def testInvalideData(self):
         """ Posting a post with an invalid body """
@@ -245,13 +285,11 @@ class TestAPI(unittest.TestCase):
         response = self.client.post("/api/posts",
             data=json.dumps(data),
             content_type="application/json",
-            headers=[("Accept", "application/json")]
+            headers=_JSON_HEADERS
         )
 
-        self.assertEqual(response.status_code, 422)
-
-        data = json.loads(response.data)
-        self.assertEqual(data["message"], "32 is not of type 'string'")
+        self.assertEqual(self._json_ok(response, 422),
+            {"message": "32 is not of type 'string'"})
 
     def testMissingData(self):
         """ Posting a post with a missing body """
@@ -262,51 +300,42 @@ class TestAPI(unittest.TestCase):
         response = self.client.post("/api/posts",
             data=json.dumps(data),
             content_type="application/json",
-            headers=[("Accept", "application/json")]
+            headers=_JSON_HEADERS
             )
 
-        self.assertEqual(response.status_code, 422)
-
-        data = json.loads(response.data)
-        self.assertEqual(data["message"], "'body' is a required property")
+        self.assertEqual(self._json_ok(response, 422),
+            {"message": "'body' is a required property"})
 
     def testPostsPut(self):
         """ Editing an existing post """
-        postA = models.Post(title="Title A", body=
+        postA = self.models.Post(title="Title A", body=
             "Posting up over heeeere")
-        session.add_all([postA])
-        session.commit()
+        self.session.add_all([postA])
+        self.session.flush()
+        post_id = postA.id
 
-        data = {
-        "title": "Example Post",
-        "body": "Just a test"
-        }
-
-        response = self.client.put("/api/posts/1",
-            data=json.dumps(data),
+        response = self.client.put("/api/posts/{}".format(post_id),
+            data=_POST_BODY,
             content_type="application/json",
-            headers=[("Accept", "application/json")]
+            headers=_JSON_HEADERS
             )
 
-        self.assertEqual(response.status_code, 201)
-        self.assertEqual(response.mimetype, "application/json")
-        self.assertEqual(urlparse(response.headers.get("Location")).path,
-            "/api/posts/1")
+        data = self._json_ok(response, 201)
+        self.assertEqual(response.location,
+            "http://localhost/api/posts/{}".format(post_id))
 
-        data = json.loads(response.data)
-        self.assertEqual(data["id"], 1)
+        self.assertEqual(data["id"], post_id)
         self.assertEqual(data["title"], "Example Post")
         self.assertEqual(data["body"], "Just a test")
 
-        posts = session.query(models.Post).all()
+        # Reload the posts rather than trusting the identity map
+        self.session.expire_all()
+        posts = self.session.query(self.models.Post).all()
         self.assertEqual(len(posts), 1)
 
         post = posts[0]
         self.assertEqual(post.title, "Example Post")
         self.assertEqual(post.body, "Just a test")
 
-
-
-
 if __name__ == "__main__":
     unittest.main()